@@ -23,7 +23,7 @@ from monai.transforms import (
 
 from stai_utils.datasets.dataset_utils import FileListDataset
 from stai_utils.evaluations.models.resnet import resnet10
-from stai_utils.evaluations.util import create_dataloader_from_dir
+from stai_utils.evaluations.util import PrefetchLoader
 from stai_utils.evaluations.metrics.age_regressor import get_ageregressor_model
 from stai_utils.evaluations.metrics.sex_classifier import get_sexclassifier_model
 
@@ -50,9 +50,12 @@ def _get_medicalnet_model():
     res10.conv_seg = torch.nn.Sequential(
         torch.nn.AdaptiveAvgPool3d(1), torch.nn.Flatten()
     )
-    res10 = torch.nn.DataParallel(res10)
-    ckpt = torch.load(checkpoint_path)
-    res10.load_state_dict(ckpt["state_dict"], strict=False)
+    ckpt = torch.load(checkpoint_path, map_location="cpu")
+    # Checkpoint was saved from a DataParallel wrapper; load it into the bare model
+    state_dict = {
+        k.replace("module.", "", 1): v for k, v in ckpt["state_dict"].items()
+    }
+    res10.load_state_dict(state_dict, strict=False)
     res10.eval()
     return res10
 
@@ -63,23 +66,86 @@ def _get_imagenet_model():
     return res50
 
 
+class _FeatureMemmap:
+    """
+    Collects per-sample features into an (N, F) CPU tensor and persists them to a single
+    feats.npy array in a directory, alongside age.npy and sex.npy.
+    """
+
+    def __init__(self, dest_dir, num_samples):
+        self.dest_dir = dest_dir
+        self.num_samples = num_samples
+        self.tmp_path = os.path.join(dest_dir, "feats.npy.tmp")
+        self.feats = None
+        self.feats_mm = None
+        self.ages = np.empty(num_samples, dtype=np.float32)
+        self.sexes = np.empty(num_samples, dtype=np.float32)
+
+    def write(self, start, feats, ages, sexes):
+        # Features may come out of autocast in float16
+        feats = feats.detach().float().cpu()
+        if self.feats is None:
+            self.feats = torch.empty((self.num_samples, feats.shape[1]))
+            self.feats_mm = np.lib.format.open_memmap(
+                self.tmp_path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(self.num_samples, feats.shape[1]),
+            )
+        end = start + len(feats)
+        self.feats[start:end] = feats
+        self.feats_mm[start:end] = feats.numpy()
+        self.ages[start:end] = ages
+        self.sexes[start:end] = sexes
+
+    def close(self):
+        self.feats_mm.flush()
+        self.feats_mm = None
+        # Only expose feats.npy once it is complete
+        os.replace(self.tmp_path, os.path.join(self.dest_dir, "feats.npy"))
+        np.save(os.path.join(self.dest_dir, "age.npy"), self.ages)
+        np.save(os.path.join(self.dest_dir, "sex.npy"), self.sexes)
+        return self.feats
+
+
+def _autocast(device):
+    """Float16 autocast on CUDA; a no-op on other devices."""
+    device_type = torch.device(device).type
+    return torch.autocast(
+        device_type, dtype=torch.float16, enabled=device_type == "cuda"
+    )
+
+
+def _features_exist(feat_dir, num_samples):
+    feat_path = os.path.join(feat_dir, "feats.npy")
+    if not os.path.exists(feat_path):
+        return False
+    return np.load(feat_path, mmap_mode="r").shape[0] == num_samples
+
+
+def _load_features(feat_dir):
+    return torch.from_numpy(np.load(os.path.join(feat_dir, "feats.npy")))
+
+
 def _extract_ageregressor_features_to_dir(
     loader, dest_dir, feature_extractor, device, skip_existing=False
 ):
     dataset = loader.dataset
+    if skip_existing and _features_exist(dest_dir, len(dataset)):
+        print(f"Skipping because features in {dest_dir} already exist...")
+        return _load_features(dest_dir)
+
+    feat_memmap = _FeatureMemmap(dest_dir, len(dataset))
     for i in tqdm(range(len(dataset)), desc="Extracting age regressor features"):
-        save_path = os.path.join(dest_dir, f"feat_{i}.npz")
-        if skip_existing and os.path.exists(save_path):
-            print(f"Skipping because {save_path} already exists...")
-            continue
         data = dataset[i]
         image = torch.tensor(data["vol_data"]).float().to(device)[None]
         age = data["vol_data"].meta["age"]
         sex = data["vol_data"].meta["sex"]
-        feat = feature_extractor(image)
-        print(feat.shape)
+        with torch.inference_mode(), _autocast(device):
+            feat = feature_extractor(image)
 
-        np.savez(save_path, feat=feat[0].cpu().detach().numpy(), age=age, sex=sex)
+        feat_memmap.write(i, feat, age, sex)
+    return feat_memmap.close()
 
 
 def _extract_medicalnet_features_to_dir(
@@ -90,88 +156,88 @@ def _extract_medicalnet_features_to_dir(
         From MedicalNet repository: https://github.com/Tencent/MedicalNet/blob/master/datasets/brains18.py.
         They do data resizing and z-score normalization before feeding the data to the model.
 
-        normalize the itensity of an nd volume based on the mean and std of nonzeor region
+        normalize the itensity of each volume in a batch based on the mean and std of its nonzero region
         inputs:
-            volume: the input nd volume
+            volume: the input (B, C, D, H, W) batch of volumes
         outputs:
-            out: the normalized nd volume
+            out: the normalized batch of volumes
         """
 
-        pixels = volume[volume > 0]
-        mean = pixels.mean()
-        std = pixels.std()
-        out = (volume - mean) / std
-        out_random = (
-            torch.tensor(np.random.normal(0, 1, size=volume.shape))
-            .float()
-            .to(volume.device)
+        # Per-sample statistics over the nonzero voxels
+        mask = (volume > 0).flatten(1)
+        flat = volume.flatten(1)
+        count = mask.sum(1, keepdim=True)
+        mean = (flat * mask).sum(1, keepdim=True) / count
+        var = (((flat - mean) * mask) ** 2).sum(1, keepdim=True) / (count - 1)
+        shape = (-1,) + (1,) * (volume.ndim - 1)
+        mean = mean.view(shape)
+        std = var.sqrt().view(shape)
+        return torch.where(
+            volume == 0, torch.randn_like(volume), (volume - mean) / std
         )
-        out[volume == 0] = out_random[volume == 0]
-        return out
 
-    dataset = loader.dataset
-    for i in tqdm(range(len(dataset)), desc="Extracting MedicalNet features"):
-        save_path = os.path.join(dest_dir, f"feat_{i}.npz")
-        if skip_existing and os.path.exists(save_path):
-            print(f"Skipping because {save_path} already exists...")
-            continue
-        data = dataset[i]
-        image = torch.tensor(data["vol_data"]).float().to(device)[None]
+    if skip_existing and _features_exist(dest_dir, len(loader.dataset)):
+        print(f"Skipping because features in {dest_dir} already exist...")
+        return _load_features(dest_dir)
+
+    feat_memmap = _FeatureMemmap(dest_dir, len(loader.dataset))
+    start = 0
+    for data in tqdm(loader, desc="Extracting MedicalNet features"):
+        image = data["vol_data"].as_tensor().float().to(device)
         image = __itensity_normalize_one_volume__(image)
-        age = data["vol_data"].meta["age"]
-        sex = data["vol_data"].meta["sex"]
-        feat = feature_extractor(image)
+        ages = data["vol_data"].meta["age"]
+        sexes = data["vol_data"].meta["sex"]
+        with torch.inference_mode(), _autocast(device):
+            feats = feature_extractor(image)
 
-        np.savez(save_path, feat=feat[0].cpu().detach().numpy(), age=age, sex=sex)
+        feat_memmap.write(start, feats, ages, sexes)
+        start += len(feats)
+    return feat_memmap.close()
 
 
 def _extract_imagenet_features_to_dir(
     loader, dest_dir, feature_extractor, device, skip_existing=False
 ):
-    # transforms to convert the input image to the format expected by the model
-    def subtract_mean(x: torch.Tensor) -> torch.Tensor:
-        """Normalize an input image by subtracting the mean."""
-        mean = [0.406, 0.456, 0.485]
-        x[:, 0, :, :] -= mean[0]
-        x[:, 1, :, :] -= mean[1]
-        x[:, 2, :, :] -= mean[2]
-        return x
+    # Mean used during training and 'RGB' -> 'BGR' channel order, cached on device
+    mean = torch.tensor([0.406, 0.456, 0.485], device=device).view(1, 3, 1, 1)
+    bgr = torch.tensor([2, 1, 0], device=device)
 
     def _get_imagenet_features(image, model):
         """Get features from the input image."""
-        # If input has just 1 channel, repeat channel to have 3 channels
-        if image.shape[1]:
-            image = image.repeat(1, 3, 1, 1)
+        # If input has just 1 channel, expand channel to have 3 channels
+        if image.shape[1] == 1:
+            image = image.expand(-1, 3, -1, -1)
 
         # Change order from 'RGB' to 'BGR'
-        image = image[:, [2, 1, 0], ...]
+        image = image.index_select(1, bgr)
 
         # Subtract mean used during training
-        image = subtract_mean(image)
+        image = image - mean
 
         # Get model outputs
-        with torch.no_grad():
+        with torch.inference_mode(), _autocast(image.device):
             feature_image = model(image)
 
         return feature_image
 
-    dataset = loader.dataset
-    for i in tqdm(range(len(dataset)), desc="Extracting ImageNet features"):
-        save_path = os.path.join(dest_dir, f"feat_{i}.npz")
-        if skip_existing and os.path.exists(save_path):
-            print(f"Skipping because {save_path} already exists...")
-            continue
+    if skip_existing and _features_exist(dest_dir, len(loader.dataset)):
+        print(f"Skipping because features in {dest_dir} already exist...")
+        return _load_features(dest_dir)
 
-        data = dataset[i]
+    feat_memmap = _FeatureMemmap(dest_dir, len(loader.dataset))
+    start = 0
+    for data in tqdm(loader, desc="Extracting ImageNet features"):
         # Convert to 2d
-        image = data["vol_data"][None]
+        image = data["vol_data"].as_tensor()
         image = image[:, :, image.shape[2] // 2]
-        image = torch.tensor(image).float().to(device)
-        age = data["vol_data"].meta["age"]
-        sex = data["vol_data"].meta["sex"]
-        feat = _get_imagenet_features(image, feature_extractor)
+        image = image.float().to(device)
+        ages = data["vol_data"].meta["age"]
+        sexes = data["vol_data"].meta["sex"]
+        feats = _get_imagenet_features(image, feature_extractor)
 
-        np.savez(save_path, feat=feat[0].cpu().detach().numpy(), age=age, sex=sex)
+        feat_memmap.write(start, feats, ages, sexes)
+        start += len(feats)
+    return feat_memmap.close()
 
 
 def evaluate_fid_ageregressor(
@@ -253,14 +319,17 @@ def evaluate_fid_ageregressor(
 
     # Extract features from the real and fake samples
     print("Extracting age regressor features...")
-    _extract_ageregressor_features_to_dir(
+    real_feats = _extract_ageregressor_features_to_dir(
         real_img_loader,
         real_feat_dir,
         ageregressor,
         device,
         skip_existing=skip_existing,
     )
-    _extract_ageregressor_features_to_dir(
+    # Release the real pass's cached GPU memory before extracting fake features
+    if torch.device(device).type == "cuda":
+        torch.cuda.empty_cache()
+    fake_feats = _extract_ageregressor_features_to_dir(
         fake_img_loader,
         fake_feat_dir,
         ageregressor,
@@ -268,15 +337,7 @@ def evaluate_fid_ageregressor(
         skip_existing=skip_existing,
     )
 
-    real_feat_loader = create_dataloader_from_dir(real_feat_dir)
-    fake_feat_loader = create_dataloader_from_dir(fake_feat_dir)
-
-    real_feats = []
-    fake_feats = []
-    for real, fake in zip(real_feat_loader, fake_feat_loader):
-        real_feats.append(real["feat"])
-        fake_feats.append(fake["feat"])
-    return FIDMetric()(torch.vstack(fake_feats), torch.vstack(real_feats)).item()
+    return FIDMetric()(fake_feats, real_feats).item()
 
 
 def evaluate_fid_medicalnet3d(
@@ -287,6 +348,8 @@ def evaluate_fid_medicalnet3d(
     device,
     skip_existing,
     apply_val_transforms=False,
+    batch_size=8,
+    num_workers=4,
 ):
     # Load the medicalnet model
     medicalnet = _get_medicalnet_model().to(device)
@@ -336,10 +399,10 @@ def evaluate_fid_medicalnet3d(
             transform=val_transforms,
             data_key=data_key,
         ),
-        batch_size=1,
+        batch_size=batch_size,
         shuffle=False,
-        num_workers=0,
-        pin_memory=False,
+        num_workers=num_workers,
+        pin_memory=torch.device(device).type == "cuda",
     )
     fake_img_loader = DataLoader(
         FileListDataset(
@@ -347,30 +410,33 @@ def evaluate_fid_medicalnet3d(
             transform=val_transforms,
             data_key=data_key,
         ),
-        batch_size=1,
+        batch_size=batch_size,
         shuffle=False,
-        num_workers=0,
-        pin_memory=False,
+        num_workers=num_workers,
+        pin_memory=torch.device(device).type == "cuda",
     )
 
     # Extract features from the real and fake samples
     print("Extracting medicalnet features...")
-    _extract_medicalnet_features_to_dir(
-        real_img_loader, real_feat_dir, medicalnet, device, skip_existing=skip_existing
+    real_feats = _extract_medicalnet_features_to_dir(
+        PrefetchLoader(real_img_loader, device),
+        real_feat_dir,
+        medicalnet,
+        device,
+        skip_existing=skip_existing,
     )
-    _extract_medicalnet_features_to_dir(
-        fake_img_loader, fake_feat_dir, medicalnet, device, skip_existing=skip_existing
+    # Release the real pass's cached GPU memory before extracting fake features
+    if torch.device(device).type == "cuda":
+        torch.cuda.empty_cache()
+    fake_feats = _extract_medicalnet_features_to_dir(
+        PrefetchLoader(fake_img_loader, device),
+        fake_feat_dir,
+        medicalnet,
+        device,
+        skip_existing=skip_existing,
     )
 
-    real_feat_loader = create_dataloader_from_dir(real_feat_dir)
-    fake_feat_loader = create_dataloader_from_dir(fake_feat_dir)
-
-    real_feats = []
-    fake_feats = []
-    for real, fake in zip(real_feat_loader, fake_feat_loader):
-        real_feats.append(real["feat"])
-        fake_feats.append(fake["feat"])
-    return FIDMetric()(torch.vstack(fake_feats), torch.vstack(real_feats)).item()
+    return FIDMetric()(fake_feats, real_feats).item()
 
 
 def evaluate_fid_imagenet2d(
@@ -381,6 +447,8 @@ def evaluate_fid_imagenet2d(
     device,
     skip_existing,
     apply_val_transforms=False,
+    batch_size=8,
+    num_workers=4,
 ):
     # Load the imagenet model
     imagenet = _get_imagenet_model().to(device)
@@ -430,10 +498,10 @@ def evaluate_fid_imagenet2d(
             transform=val_transforms,
             data_key=data_key,
         ),
-        batch_size=1,
+        batch_size=batch_size,
         shuffle=False,
-        num_workers=0,
-        pin_memory=False,
+        num_workers=num_workers,
+        pin_memory=torch.device(device).type == "cuda",
     )
     fake_img_loader = DataLoader(
         FileListDataset(
@@ -441,27 +509,30 @@ def evaluate_fid_imagenet2d(
             transform=val_transforms,
             data_key="vol_data",
         ),
-        batch_size=1,
+        batch_size=batch_size,
         shuffle=False,
-        num_workers=0,
-        pin_memory=False,
+        num_workers=num_workers,
+        pin_memory=torch.device(device).type == "cuda",
     )
 
     # Extract features from the real and fake samples
     print("Extracting imagenet features...")
-    _extract_imagenet_features_to_dir(
-        real_img_loader, real_feat_dir, imagenet, device, skip_existing=skip_existing
+    real_feats = _extract_imagenet_features_to_dir(
+        PrefetchLoader(real_img_loader, device),
+        real_feat_dir,
+        imagenet,
+        device,
+        skip_existing=skip_existing,
     )
-    _extract_imagenet_features_to_dir(
-        fake_img_loader, fake_feat_dir, imagenet, device, skip_existing=skip_existing
+    # Release the real pass's cached GPU memory before extracting fake features
+    if torch.device(device).type == "cuda":
+        torch.cuda.empty_cache()
+    fake_feats = _extract_imagenet_features_to_dir(
+        PrefetchLoader(fake_img_loader, device),
+        fake_feat_dir,
+        imagenet,
+        device,
+        skip_existing=skip_existing,
     )
 
-    real_feat_loader = create_dataloader_from_dir(real_feat_dir)
-    fake_feat_loader = create_dataloader_from_dir(fake_feat_dir)
-
-    real_feats = []
-    fake_feats = []
-    for real, fake in zip(real_feat_loader, fake_feat_loader):
-        real_feats.append(real["feat"])
-        fake_feats.append(fake["feat"])
-    return FIDMetric()(torch.vstack(fake_feats), torch.vstack(real_feats)).item()
+    return FIDMetric()(fake_feats, real_feats).item()
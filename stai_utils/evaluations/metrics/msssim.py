@@ -1,6 +1,11 @@
+from collections import OrderedDict
+
+import numpy as np
 import torch
+import torch.nn.functional as F
 from generative.metrics import MultiScaleSSIMMetric
 from monai.data import DataLoader, NumpyReader
+from monai.utils import MetricReduction
 from monai.transforms import (
     CenterSpatialCropd,
     Compose,
@@ -27,8 +32,191 @@ class MyReader(NumpyReader):
         return img, meta
 
 
-def compute_pairwise_msssim(paths, N=1000, apply_val_transforms=False):
-    # Build dataloader from paths
+def _gaussian_1d(kernel_size, sigma):
+    dist = torch.arange((1 - kernel_size) / 2, (1 + kernel_size) / 2, 1.0)
+    gauss = torch.exp(-((dist / sigma) ** 2) / 2)
+    return gauss / gauss.sum()
+
+
+def _separable_gaussian_filter(x, kernel_1d):
+    """Apply a 3D Gaussian window as three 1-D depthwise convolutions (valid padding)."""
+    if x.device.type == "cpu":
+        return _separable_gaussian_filter_cpu(x, kernel_1d)
+    channels = x.shape[1]
+    k = kernel_1d.numel()
+    for shape in ((k, 1, 1), (1, k, 1), (1, 1, k)):
+        weight = kernel_1d.view(1, 1, *shape).repeat(channels, 1, 1, 1, 1)
+        x = F.conv3d(x, weight, groups=channels)
+    return x
+
+
+def _separable_gaussian_filter_cpu(x, kernel_1d):
+    """
+    CPU variant of _separable_gaussian_filter that accumulates shifted slices with
+    vectorized multiply-adds, which is several times faster than depthwise conv3d on CPU.
+    """
+    taps = kernel_1d.tolist()
+    for dim in (2, 3, 4):
+        length = x.shape[dim] - len(taps) + 1
+        out = x.narrow(dim, 0, length) * taps[0]
+        for t in range(1, len(taps)):
+            out.add_(x.narrow(dim, t, length), alpha=taps[t])
+        x = out
+    return x
+
+
+def _compute_ssim_and_cs(y_pred, y, kernel_1d, c1, c2):
+    channels = y_pred.shape[1]
+
+    # Filter all first and second moments in a single pass
+    moments = torch.cat([y_pred, y, y_pred * y_pred, y * y, y_pred * y], dim=1)
+    mu_x, mu_y, mu_xx, mu_yy, mu_xy = _separable_gaussian_filter(
+        moments, kernel_1d
+    ).split(channels, dim=1)
+
+    sigma_x = torch.addcmul(mu_xx, mu_x, mu_x, value=-1)
+    sigma_y = torch.addcmul(mu_yy, mu_y, mu_y, value=-1)
+    sigma_xy = torch.addcmul(mu_xy, mu_x, mu_y, value=-1)
+
+    contrast_sensitivity = (2 * sigma_xy + c2) / (sigma_x + sigma_y + c2)
+    luminance = (2 * mu_x * mu_y + c1) / (torch.addcmul(mu_x * mu_x, mu_y, mu_y) + c1)
+    return luminance * contrast_sensitivity, contrast_sensitivity
+
+
+class SeparableMultiScaleSSIMMetric(MultiScaleSSIMMetric):
+    """
+    3D MultiScaleSSIMMetric with the Gaussian window applied as three 1-D convolutions.
+
+    Gives the same result as the dense k x k x k window while using 3k taps per voxel
+    instead of k^3. Only isotropic Gaussian windows are supported, so kernel_type and
+    per-axis kernel sizes/sigmas are not accepted.
+    """
+
+    def __init__(
+        self,
+        data_range=1.0,
+        kernel_size=11,
+        kernel_sigma=1.5,
+        k1=0.01,
+        k2=0.03,
+        weights=(0.0448, 0.2856, 0.3001, 0.2363, 0.1333),
+        use_compile=False,
+        reduction=MetricReduction.MEAN,
+        get_not_nans=False,
+    ):
+        if not isinstance(kernel_size, int) or not isinstance(kernel_sigma, (int, float)):
+            raise ValueError(
+                "SeparableMultiScaleSSIMMetric only supports isotropic windows; "
+                f"got kernel_size={kernel_size}, kernel_sigma={kernel_sigma}."
+            )
+        super().__init__(
+            spatial_dims=3,
+            data_range=data_range,
+            kernel_size=kernel_size,
+            kernel_sigma=kernel_sigma,
+            k1=k1,
+            k2=k2,
+            weights=weights,
+            reduction=reduction,
+            get_not_nans=get_not_nans,
+        )
+        self.kernel_1d = _gaussian_1d(kernel_size, kernel_sigma)
+        self.c1 = (k1 * data_range) ** 2
+        self.c2 = (k2 * data_range) ** 2
+        self.scale_weights = weights
+        # The window and constants are fixed, so the per-scale computation can be
+        # specialized once per input shape
+        self.ssim_and_cs = (
+            torch.compile(_compute_ssim_and_cs, dynamic=False)
+            if use_compile
+            else _compute_ssim_and_cs
+        )
+
+    def _compute_metric(self, y_pred, y):
+        if y_pred.ndimension() != 5:
+            raise ValueError(
+                f"Input images should be 5-dimensional (B, C, D, H, W), got {y_pred.shape}."
+            )
+        # Check the images are large enough for the downsamplings and the window
+        weights_div = max(1, len(self.scale_weights) - 1) ** 2
+        for size in y_pred.shape[2:]:
+            if size // weights_div <= self.kernel_1d.numel() - 1:
+                raise ValueError(
+                    f"For a given number of `weights` parameters {len(self.scale_weights)} and kernel size "
+                    f"{self.kernel_1d.numel()}, the image height must be larger than "
+                    f"{(self.kernel_1d.numel() - 1) * weights_div}."
+                )
+
+        y_pred = y_pred.float()
+        y = y.float()
+        if self.kernel_1d.device != y_pred.device:
+            self.kernel_1d = self.kernel_1d.to(y_pred.device)
+        weights = torch.tensor(self.scale_weights, device=y_pred.device)
+
+        multiscale_list = []
+        for _ in range(len(self.scale_weights)):
+            ssim, cs = self.ssim_and_cs(y_pred, y, self.kernel_1d, self.c1, self.c2)
+            multiscale_list.append(torch.relu(cs.flatten(1).mean(1)))
+            y_pred = F.avg_pool3d(y_pred, kernel_size=2)
+            y = F.avg_pool3d(y, kernel_size=2)
+        multiscale_list[-1] = torch.relu(ssim.flatten(1).mean(1))
+
+        ms_ssim = torch.prod(torch.stack(multiscale_list) ** weights.view(-1, 1), dim=0)
+        return ms_ssim.view(-1, 1)
+
+
+class MSSSIMBuffer:
+    """
+    Preallocated device buffers holding a batch of image pairs for MS-SSIM.
+
+    Batches are copied into the same device memory on every call instead of
+    allocating fresh tensors per batch. The full buffers are always returned so that
+    every MS-SSIM call sees the same shape; for a partial batch, only the first
+    len(imgs1) rows are valid.
+    """
+
+    def __init__(self, batch_size, image_shape, device):
+        self.img1 = torch.zeros((batch_size, *image_shape), device=device)
+        self.img2 = torch.zeros((batch_size, *image_shape), device=device)
+
+    def load(self, imgs1, imgs2):
+        for k, (img1, img2) in enumerate(zip(imgs1, imgs2)):
+            self.img1[k].copy_(img1, non_blocking=True)
+            self.img2[k].copy_(img2, non_blocking=True)
+        return self.img1, self.img2
+
+
+def compute_pairwise_msssim(
+    paths,
+    N=1000,
+    apply_val_transforms=False,
+    batch_size=8,
+    device=None,
+    seed=0,
+    use_compile=False,
+    cache_size=64,
+):
+    """
+    Mean MS-SSIM over N randomly sampled pairs of distinct volumes.
+
+    Args:
+        paths (list): Paths to the .npz volumes.
+        N (int): Number of (i, j) pairs to evaluate.
+        batch_size (int): Number of pairs per MS-SSIM call.
+        device (str, optional): Device to compute on. Defaults to CUDA when available.
+        seed (int, optional): Seed for sampling the pairs. The default fixed seed makes the
+            metric reproducible across calls; pass None to sample different pairs each time.
+        use_compile (bool): Compile the per-scale MS-SSIM computation with torch.compile.
+        cache_size (int): Maximum number of loaded volumes kept in host memory
+            (~21.6 MB each at 160x192x176 float32). When the sampled pairs touch at most
+            this many unique volumes, each volume is loaded exactly once. Otherwise the
+            least recently used volumes are evicted and may be loaded again, trading
+            repeated loads for bounded memory.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # Build dataset from paths
     data_key = "vol_data"
     spacing = (1, 1, 1)
     img_size = (160, 192, 176)
@@ -67,29 +255,46 @@ def compute_pairwise_msssim(paths, N=1000, apply_val_transforms=False):
             ]
         )
 
-    loader = DataLoader(
-        FileListDataset(
-            paths,
-            transform=val_transforms,
-            data_key=data_key,
-        ),
-        batch_size=1,
-        shuffle=False,
-        num_workers=0,
-        pin_memory=False,
+    dataset = FileListDataset(
+        paths,
+        transform=val_transforms,
+        data_key=data_key,
     )
+    if len(dataset) < 2:
+        raise ValueError("Need at least two volumes to compute pairwise MS-SSIM.")
 
+    # Sample N random (i, j) pairs with i != j up front
+    rng = np.random.default_rng(seed)
+    first = rng.integers(0, len(dataset), size=N)
+    second = (first + rng.integers(1, len(dataset), size=N)) % len(dataset)
+    pairs = np.stack([first, second], axis=1)
+    # Sort so consecutive batches share their first volume
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    # Keep at most cache_size loaded volumes resident, evicting the least recently used
+    cache = OrderedDict()
+
+    def load_volume(idx):
+        if idx in cache:
+            cache.move_to_end(idx)
+        else:
+            cache[idx] = dataset[idx][data_key].as_tensor().float()
+            if len(cache) > cache_size:
+                cache.popitem(last=False)
+        return cache[idx]
+
+    # Compute MS-SSIM over batches of pairs
     tot_metric = 0
-    count = 0
-    msssim = MultiScaleSSIMMetric(spatial_dims=3, kernel_size=9)
-    for i, data1 in enumerate(loader):
-        for j, data2 in enumerate(loader):
-            if count >= N:
-                break
-            if i != j:
-                img1 = data1["vol_data"].float()
-                img2 = data2["vol_data"].float()
-                tot_metric += msssim(img1, img2).item()
-                count += 1
-
-    return tot_metric / count
+    msssim = SeparableMultiScaleSSIMMetric(kernel_size=9, use_compile=use_compile)
+    buf = MSSSIMBuffer(batch_size, load_volume(pairs[0, 0]).shape, device)
+    with torch.inference_mode():
+        for start in range(0, N, batch_size):
+            batch_pairs = pairs[start : start + batch_size]
+            img1, img2 = buf.load(
+                [load_volume(i) for i, _ in batch_pairs],
+                [load_volume(j) for _, j in batch_pairs],
+            )
+            # Score the full buffer to keep shapes static; only the first rows are valid
+            tot_metric += msssim(img1, img2)[: len(batch_pairs)].sum().item()
+
+    return tot_metric / N
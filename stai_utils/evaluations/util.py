@@ -1,31 +1,47 @@
-import os
-import numpy as np
+import torch
 
-from monai.data import DataLoader, Dataset
 
+class PrefetchLoader:
+    """
+    Wraps a DataLoader so that the next batch's `key` tensor is copied to the device on a
+    side CUDA stream while the current batch is being processed. On non-CUDA devices,
+    batches are moved synchronously.
+    """
 
-class NPZDataset(Dataset):
-    def __init__(self, directory, transform=None):
-        """
-        Args:
-            directory (str): Path to the directory containing .npz files.
-            transform (callable, optional): Optional transform to be applied on a sample.
-        """
-        self.directory = directory
-        self.transform = transform
-        self.files = [f for f in os.listdir(directory) if f.endswith(".npz")]
+    def __init__(self, loader, device, key="vol_data"):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.key = key
 
     def __len__(self):
-        return len(self.files)
+        return len(self.loader)
 
-    def __getitem__(self, idx):
-        # Load the .npz file
-        file_path = os.path.join(self.directory, self.files[idx])
-        data = np.load(file_path)
-        return data
+    @property
+    def dataset(self):
+        return self.loader.dataset
 
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for data in self.loader:
+                data[self.key] = data[self.key].to(self.device)
+                yield data
+            return
 
-def create_dataloader_from_dir(directory, batch_size=1, shuffle=False):
-    dataset = NPZDataset(directory=directory)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
-    return dataloader
+        stream = torch.cuda.Stream(device=self.device)
+        data = None
+        for next_data in self.loader:
+            with torch.cuda.stream(stream):
+                next_data[self.key] = next_data[self.key].to(
+                    self.device, non_blocking=True
+                )
+                # The batch is consumed on the current stream; keep the allocator
+                # from reusing its memory until that work is done
+                next_data[self.key].record_stream(
+                    torch.cuda.current_stream(self.device)
+                )
+            if data is not None:
+                yield data
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            data = next_data
+        if data is not None:
+            yield data
@@ -1,10 +1,42 @@
+import functools
 import json
+import os
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import itertools
 
 
+@functools.lru_cache(maxsize=128)
+def _load_json_cached(json_path, mtime):
+    with open(json_path, "r") as f:
+        return json.load(f)
+
+
+def _load_json(json_path):
+    """
+    Load a JSON file, reusing the parsed result across plot calls until the file changes.
+    The returned object is shared between calls and should not be modified.
+    """
+    return _load_json_cached(json_path, os.path.getmtime(json_path))
+
+
+def build_color_map(models, colors=None):
+    """
+    Map each model name to a color, falling back to the default color cycle.
+
+    Args:
+        models (iterable): Model names, in plotting order.
+        colors (dict, optional): A dictionary mapping model names to specific colors.
+    """
+    colors = colors or {}
+    default_colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+    return {
+        model: colors.get(model, default_colors[i % len(default_colors)])
+        for i, model in enumerate(models)
+    }
+
+
 def boxplot_loss_vs_agebins(
     models, bins_to_ignore=None, box_widths=0.2, colors=None, save_path=None
 ):
@@ -18,17 +50,12 @@ def boxplot_loss_vs_agebins(
     all_data = []
 
     # Get default color cycle if no colors provided
-    default_colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
-    color_map = {
-        model: colors.get(model, default_colors[i % len(default_colors)])
-        for i, model in enumerate(models.keys())
-    }
+    color_map = build_color_map(models.keys(), colors)
 
     # Iterate over the models to load and process the data
     for model_name, json_path in models.items():
         # Load the JSON data
-        with open(json_path, "r") as f:
-            data = json.load(f)
+        data = _load_json(json_path)
 
         # Convert to DataFrame
         df = pd.DataFrame(data)
@@ -48,12 +75,11 @@ def boxplot_loss_vs_agebins(
         combined_df = combined_df[~combined_df["decade"].isin(bins_to_ignore)]
 
     # Prepare the data for manual plotting
-    grouped = (
-        combined_df.groupby(["decade", "model"])["loss"]
-        .apply(list)
-        .unstack(fill_value=[])
-    )
-    decades = grouped.index
+    grouped = {
+        key: group.to_numpy()
+        for key, group in combined_df.groupby(["decade", "model"])["loss"]
+    }
+    decades = np.sort(combined_df["decade"].unique())
     models_list = list(models.keys())
 
     # Calculate positions
@@ -68,7 +94,7 @@ def boxplot_loss_vs_agebins(
             x_positions - total_width / 2 + i * box_widths + box_widths / 2
         )
         plt.boxplot(
-            grouped[model_name],
+            [grouped.get((decade, model_name), []) for decade in decades],
             positions=model_positions,
             widths=box_widths,
             patch_artist=True,
@@ -119,8 +145,7 @@ def boxplot_loss_vs_agebins(
 
 def boxplot_accuracy_vs_sex(json_file):
     # Load the JSON data
-    with open(json_file, "r") as f:
-        data = json.load(f)
+    data = _load_json(json_file)
 
     # Convert to DataFrame
     df = pd.DataFrame(data)
@@ -146,8 +171,7 @@ def boxplot_accuracy_vs_sex(json_file):
 
 def lineplot_accuracy_vs_sex(json_file):
     # Load the JSON data
-    with open(json_file, "r") as f:
-        data = json.load(f)
+    data = _load_json(json_file)
 
     # Convert to DataFrame
     df = pd.DataFrame(data)
@@ -186,6 +210,19 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 
+def _voxel_counts_frame(data):
+    """
+    Flatten a {filename: {structure_index: voxel_count}} dictionary into a long-form
+    DataFrame with columns "file", "idx" and "vox".
+    """
+    rows = [
+        (filename, int(structure_index), voxel_count)
+        for filename, structures in data.items()
+        for structure_index, voxel_count in structures.items()
+    ]
+    return pd.DataFrame(rows, columns=["file", "idx", "vox"])
+
+
 def boxplot_voxel_distributions(models_dict, index_to_name, indices_to_ignore=None):
     """
     Generate grouped boxplots for voxel distributions across brain structures from multiple models,
@@ -200,22 +237,17 @@ def boxplot_voxel_distributions(models_dict, index_to_name, indices_to_ignore=No
 
     for model_name, json_path in models_dict.items():
         # Load the JSON data
-        with open(json_path, "r") as file:
-            data = json.load(file)
+        data = _load_json(json_path)
 
         # Collect voxel counts for each brain structure index
-        brain_structure_voxels = {}
-        for filename, structures in data.items():
-            for structure_index, voxel_count in structures.items():
-                if indices_to_ignore and int(structure_index) in indices_to_ignore:
-                    continue
-                structure_index = int(structure_index)  # Ensure indices are integers
-                if structure_index not in brain_structure_voxels:
-                    brain_structure_voxels[structure_index] = []
-                brain_structure_voxels[structure_index].append(voxel_count)
+        df = _voxel_counts_frame(data)
+        if indices_to_ignore:
+            df = df[~df["idx"].isin(indices_to_ignore)]
 
         # Add data to all_data for this model
-        all_data[model_name] = brain_structure_voxels
+        all_data[model_name] = {
+            index: group.to_numpy() for index, group in df.groupby("idx")["vox"]
+        }
 
     # Get all unique brain structure indices across all models
     all_indices = sorted(
@@ -284,21 +316,11 @@ def boxplot_grouped_voxel_distributions(
 
     for model_name, json_path in models_dict.items():
         # Load the JSON data
-        with open(json_path, "r") as file:
-            data = json.load(file)
-
-        # Collect voxel counts for each brain structure index
-        brain_structure_voxels = {}
-        for filename, structures in data.items():
-            for structure_index, voxel_count in structures.items():
-                structure_index = int(structure_index)  # Ensure indices are integers
-                if structure_index not in ignore_indices:  # Skip ignored indices
-                    if structure_index not in brain_structure_voxels:
-                        brain_structure_voxels[structure_index] = []
-                    brain_structure_voxels[structure_index].append(voxel_count)
+        data = _load_json(json_path)
 
-        # Add data to all_data for this model
-        all_data[model_name] = brain_structure_voxels
+        # Collect voxel counts for each brain structure index, skipping ignored indices
+        df = _voxel_counts_frame(data)
+        all_data[model_name] = df[~df["idx"].isin(ignore_indices)]
 
     # Prepare grouped data
     grouped_data = {
@@ -307,10 +329,10 @@ def boxplot_grouped_voxel_distributions(
     }
     for group_name, indices in structure_groups.items():
         for model_name in models_dict.keys():
-            group_voxels = []
-            for index in indices:
-                group_voxels.extend(all_data.get(model_name, {}).get(index, []))
-            grouped_data[model_name][group_name] = group_voxels
+            df = all_data[model_name]
+            grouped_data[model_name][group_name] = df.loc[
+                df["idx"].isin(indices), "vox"
+            ].to_numpy()
 
     # Prepare data for plotting
     group_names = list(structure_groups.keys())
@@ -370,8 +392,7 @@ def barplot_absolute_cohens_d(model_files):
     # Load all JSON data
     data = {}
     for model_name, file_path in model_files.items():
-        with open(file_path, "r") as f:
-            data[model_name] = json.load(f)
+        data[model_name] = _load_json(file_path)
 
     # Collect all brain structure indices (union of keys across all models)
     all_indices = sorted(
@@ -430,19 +451,31 @@ def barplot_grouped_absolute_cohens_d(
     # Load all JSON data
     data = {}
     for model_name, file_path in model_files.items():
-        with open(file_path, "r") as f:
-            data[model_name] = json.load(f)
+        data[model_name] = _load_json(file_path)
+
+    # Filter out ignored indices
+    region_indices = {
+        region: np.array([i for i in indices if i not in ignore_indices], dtype=int)
+        for region, indices in structure_groups.items()
+    }
+    max_index = max(
+        (indices.max() for indices in region_indices.values() if indices.size),
+        default=-1,
+    )
 
     # Compute grouped Cohen's d values
     grouped_data = {region: {} for region in structure_groups}
     for model_name, model_data in data.items():
-        for region, indices in structure_groups.items():
-            # Filter out ignored indices
-            indices = [i for i in indices if i not in ignore_indices]
+        # Absolute Cohen's d per structure index, 0 if the index is missing in a model
+        keys = np.fromiter(map(int, model_data.keys()), dtype=int, count=len(model_data))
+        values = np.fromiter(model_data.values(), dtype=float, count=len(model_data))
+        in_range = keys <= max_index
+        abs_d = np.zeros(max_index + 1)
+        abs_d[keys[in_range]] = np.abs(values[in_range])
+
+        for region, indices in region_indices.items():
             # Compute the absolute Cohen's d for all valid indices in the group
-            grouped_data[region][model_name] = np.mean(
-                [abs(model_data.get(str(i), 0)) for i in indices]
-            )
+            grouped_data[region][model_name] = abs_d[indices].mean()
 
     # Create the bar plot
     x = np.arange(len(structure_groups))  # X-axis positions for brain regions
@@ -451,11 +484,7 @@ def barplot_grouped_absolute_cohens_d(
     plt.figure(figsize=(14, 4))
 
     # Get default color cycle if no colors provided
-    default_colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
-    color_map = {
-        model: colors.get(model, default_colors[i % len(default_colors)])
-        for i, model in enumerate(model_files.keys())
-    }
+    color_map = build_color_map(model_files.keys(), colors)
 
     for i, model_name in enumerate(model_files.keys()):
         # Extract grouped values for the current model
@@ -499,13 +528,14 @@ def barplot_grouped_absolute_cohens_d(
     plt.show()
 
 
-def scatterplot_labels_vs_predictions(model_dict):
+def scatterplot_labels_vs_predictions(model_dict, save_path=None):
     """
     Create a scatter plot for multiple models where the x-axis is the label and the y-axis is the prediction.
     Different models have different colors/shapes, and the legend maps each to the corresponding model name.
 
     Args:
         model_dict (dict): A dictionary where keys are model names and values are paths to JSON files containing data.
+        save_path (str, optional): Where to save the figure. Points are rasterized, so vector formats stay small.
     """
     # Marker styles and colors for differentiating models
     markers = itertools.cycle(("o", "s", "D", "P", "^", "v", "<", ">"))
@@ -515,8 +545,7 @@ def scatterplot_labels_vs_predictions(model_dict):
 
     for model_name, json_path in model_dict.items():
         # Load the JSON data
-        with open(json_path, "r") as f:
-            data = json.load(f)
+        data = _load_json(json_path)
 
         # Extract labels and predictions
         labels = [item["label"] for item in data]
@@ -530,6 +559,7 @@ def scatterplot_labels_vs_predictions(model_dict):
             alpha=0.7,
             marker=next(markers),
             color=next(colors),
+            rasterized=True,
         )
 
     # Add legend, title, and axis labels
@@ -538,4 +568,9 @@ def scatterplot_labels_vs_predictions(model_dict):
     plt.xlabel("Label")
     plt.ylabel("Prediction")
     plt.grid(True)
+
+    if save_path:
+        # Only the rasterized points depend on dpi in vector formats
+        dpi = 150 if save_path.endswith(".pdf") else 300
+        plt.savefig(save_path, dpi=dpi, bbox_inches="tight")
     plt.show()